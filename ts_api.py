@@ -1,18 +1,28 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from playwright.sync_api import sync_playwright
-import time
-import json
+from playwright.async_api import async_playwright
+import asyncio
+import hashlib
+import orjson
 import os
 import sys
+import threading
+import time
+import uuid
 from collections import defaultdict
+from functools import lru_cache
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime
+from contextlib import asynccontextmanager
 
 # --- Database Imports ---
-from sqlalchemy import create_engine, Column, String, Text, DateTime
+from sqlalchemy import create_engine, event, func, inspect, cast, Column, String, DateTime, JSON, Index, text
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
@@ -48,146 +58,437 @@ DATABASE_URL = os.getenv("DATABASE_URL", NEON_DB_URL)
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+def set_sqlite_pragma(dbapi_conn, _record):
+    # WAL lets the n8n reader run alongside /timetable writes
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.close()
+
+def dump_json(obj):
+    return orjson.dumps(obj).decode()
+
+def make_engine(url):
+    if url.startswith("sqlite"):
+        # Requests are served from FastAPI's threadpool, not the creating thread
+        sqlite_engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            json_serializer=dump_json,
+            json_deserializer=orjson.loads,
+        )
+        event.listen(sqlite_engine, "connect", set_sqlite_pragma)
+        return sqlite_engine
+    return create_engine(
+        url,
+        json_serializer=dump_json,
+        json_deserializer=orjson.loads,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    )
+
 log(f"💽 Connecting DB...")
 
 try:
-    engine = create_engine(DATABASE_URL)
+    engine = make_engine(DATABASE_URL)
+    with engine.connect(): pass
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     Base = declarative_base()
-    Base.metadata.create_all(bind=engine)
     log("✅ DB Connected")
 except Exception as e:
     log(f"❌ DB Error: {e}")
     # Fallback to local
     DATABASE_URL = f"sqlite:///{os.path.join(BASE_DIR, 'local_database.db')}"
-    engine = create_engine(DATABASE_URL)
+    engine = make_engine(DATABASE_URL)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     Base = declarative_base()
-    Base.metadata.create_all(bind=engine)
 
 class UserDB(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # n8n only ever reads users who registered a LINE token
+        Index(
+            "ix_users_line_token_present", "line_token",
+            postgresql_where=text("line_token IS NOT NULL"),
+            sqlite_where=text("line_token IS NOT NULL"),
+        ),
+    )
     username = Column(String, primary_key=True, index=True)
     line_token = Column(String, nullable=True)
-    schedule_json = Column(Text, default="[]") 
-    last_updated = Column(DateTime, default=datetime.now)
+    schedule_json = Column(JSON().with_variant(JSONB, "postgresql"), default=list) 
+    last_updated = Column(DateTime, default=func.now())
+
+class DailyScheduleDB(Base):
+    # One row per user per day that has classes, already sorted for n8n
+    __tablename__ = "daily_schedules"
+    username = Column(String, primary_key=True)
+    day = Column(String, primary_key=True, index=True)
+    classes_json = Column(JSON().with_variant(JSONB, "postgresql"), default=list)
+
+Base.metadata.create_all(bind=engine)
+
+def migrate_schedule_json():
+    # create_all never alters existing tables; older Postgres DBs still store schedule_json as text
+    if engine.dialect.name != "postgresql": return
+    col = next(c for c in inspect(engine).get_columns("users") if c["name"] == "schedule_json")
+    if isinstance(col["type"], JSONB): return
+    log(f"🔧 Migrating users.schedule_json from {col['type']} to jsonb...")
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE users ALTER COLUMN schedule_json TYPE jsonb USING NULLIF(schedule_json::text, '')::jsonb"))
+    log("✅ users.schedule_json migrated")
+
+try: migrate_schedule_json()
+except Exception as e: log(f"❌ Migration Error: {e}")
+
+def load_schedule(value):
+    # Rows read before the jsonb migration (or if it failed) come back as raw JSON text
+    if isinstance(value, (str, bytes)): return orjson.loads(value) if value else []
+    return value or []
 
 def get_db():
     db = SessionLocal()
     try: yield db
     finally: db.close()
 
+def dialect_insert(table):
+    # Postgres and SQLite both support ON CONFLICT, but through their own insert()
+    return (pg_insert if engine.dialect.name == "postgresql" else sqlite_insert)(table)
+
+def upsert_user(db, username, **values):
+    # Single INSERT ... ON CONFLICT DO UPDATE instead of SELECT then INSERT/UPDATE
+    stmt = dialect_insert(UserDB).values(username=username, **values)
+    stmt = stmt.on_conflict_do_update(index_elements=[UserDB.username], set_=values)
+    db.execute(stmt)
+
+def daily_rows(username, schedule):
+    return [
+        {"username": username, "day": day, "classes_json": classes}
+        for day, classes in split_by_day(schedule).items()
+    ]
+
+def save_schedule(db, username, schedule):
+    upsert_user(db, username, schedule_json=schedule, last_updated=datetime.now())
+    db.query(DailyScheduleDB).filter(DailyScheduleDB.username == username).delete(synchronize_session=False)
+    db.add_all(DailyScheduleDB(**row) for row in daily_rows(username, schedule))
+    db.commit()
+
+def store_schedule(username, schedule):
+    # For callers outside a request (background jobs) that have no Depends(get_db) session
+    with SessionLocal() as db:
+        save_schedule(db, username, schedule)
+
+@app.on_event("startup")
+def backfill_daily_schedules():
+    # Users saved before daily_schedules existed get their per-day rows once
+    with SessionLocal() as db:
+        missing = db.query(UserDB.username, UserDB.schedule_json).filter(
+            UserDB.schedule_json.isnot(None),
+            cast(UserDB.schedule_json, String).notin_(["", "[]", "null"]),
+            ~UserDB.username.in_(db.query(DailyScheduleDB.username))
+        ).all()
+        rows = []
+        for username, schedule in missing:
+            try: rows += daily_rows(username, load_schedule(schedule))
+            except Exception as e: log(f"⚠️ Bad schedule for {username}: {e}")
+        # Several workers may boot at once and backfill the same users
+        if rows: db.execute(dialect_insert(DailyScheduleDB).values(rows).on_conflict_do_nothing())
+        db.commit()
+    if rows: log(f"✅ Backfilled daily schedules for {len({r['username'] for r in rows})} users")
+
 # ------------------- Maps Logic ------------------- #
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL") 
 SERVER_URL = RENDER_EXTERNAL_URL if RENDER_EXTERNAL_URL else "http://localhost:8080"
-
+MAP_EXTENSIONS = (".jpg", ".png", ".jpeg")
+
+BUILDING_MAP = {
+    "S": "ตึก 100 ปี (สมเด็จพระเทพฯ)",
+    "P": "อาคารวิทยาศาสตร์ (P)",
+    "L": "อาคารเรียนรวม (L)",
+    "QS2": "อาคารภูมิราชนครินทร์ (QS2)",
+    "KB": "อาคารเคบี (KB)",
+    "SC": "อาคารวิทยาศาสตร์ (SC)",
+    "EN": "คณะวิศวกรรมศาสตร์",
+}
+ONLINE_PREFIXES = frozenset({"ARR"})
+ONLINE_BUILDING = "เรียนออนไลน์จ้า"
+
+def build_map_index():
+    # room_code -> public image URL, preferring extensions in MAP_EXTENSIONS order
+    found = {}
+    for filename in os.listdir(MAPS_DIR):
+        stem, ext = os.path.splitext(filename)
+        if ext in MAP_EXTENSIONS:
+            found.setdefault(stem, []).append(ext)
+    return {
+        stem: f"{SERVER_URL}/static/maps/{stem}{min(exts, key=MAP_EXTENSIONS.index)}"
+        for stem, exts in found.items()
+    }
+
+MAP_INDEX = build_map_index()
+
+def refresh_map_index():
+    global MAP_INDEX
+    MAP_INDEX = build_map_index()
+    get_room_details.cache_clear()
+    return len(MAP_INDEX)
+
+@lru_cache(maxsize=4096)
 def get_room_details(room_code):
     room_code = room_code.strip()
-    parts = room_code.split('-')
-    prefix = parts[0].upper().strip() if len(parts) > 0 else room_code
+    # "-" is the scraper's filler when the grid cell has no room
+    if room_code in ("", "-"): return "-", ""
+    prefix = room_code.partition('-')[0].upper().strip()
     
-    building_name = f"อาคาร {prefix}"
-    if prefix == "S": building_name = "ตึก 100 ปี (สมเด็จพระเทพฯ)"
-    elif prefix == "P": building_name = "อาคารวิทยาศาสตร์ (P)"
-    elif prefix == "L": building_name = "อาคารเรียนรวม (L)"
-    elif prefix == "QS2": building_name = "อาคารภูมิราชนครินทร์ (QS2)"
-    elif prefix == "KB": building_name = "อาคารเคบี (KB)"
-    elif prefix == "SC": building_name = "อาคารวิทยาศาสตร์ (SC)"
-    elif prefix == "EN": building_name = "คณะวิศวกรรมศาสตร์"
-    elif prefix == "ARR" or "ONLINE" in room_code.upper(): building_name = "เรียนออนไลน์จ้า"
-
-    full_image_url = ""
-    valid_extensions = [".jpg", ".png", ".jpeg"]
-    for ext in valid_extensions:
-        filename = f"{room_code}{ext}"
-        image_path = os.path.join(MAPS_DIR, filename)
-        if os.path.exists(image_path):
-            full_image_url = f"{SERVER_URL}/static/maps/{filename}"
-            break
+    if prefix in BUILDING_MAP: building_name = BUILDING_MAP[prefix]
+    elif prefix in ONLINE_PREFIXES or "ONLINE" in room_code.upper(): building_name = ONLINE_BUILDING
+    else: building_name = f"อาคาร {prefix}"
+
+    full_image_url = MAP_INDEX.get(room_code, "")
     
     return building_name, full_image_url
 
-def safe_text(locator):
-    try: return locator.inner_text().strip()
-    except: return ""
+def enrich_schedule(data):
+    # data is freshly scraped and not shared, so add room details in place
+    sessions = [s for subject in data for s in subject.get("schedules", [])]
+    room_info = {room: get_room_details(room) for room in {s["room"] for s in sessions}}
+    for session in sessions:
+        session["building"], session["map_image"] = room_info[session["room"]]
+    return data
 
+@lru_cache(maxsize=1024)
 def parse_time(time_str):
-    try: return datetime.strptime(time_str, "%H:%M")
-    except: return datetime.max
+    # time is "HH:MM-HH:MM"; sort on the start time as minutes past midnight
+    # isdecimal, not isdigit: "²" passes isdigit but int() rejects it
+    if len(time_str) >= 5 and time_str[2] == ":" and time_str[:2].isdecimal() and time_str[3:5].isdecimal():
+        return int(time_str[:2]) * 60 + int(time_str[3:5])
+    return 1 << 30
+
+def split_by_day(schedule):
+    by_day = defaultdict(list)
+    for subj in schedule:
+        for s in subj.get("schedules", []):
+            by_day[s["day"]].append({
+                "code": subj["code"], 
+                "name_en": subj["name_en"], # ส่งชื่ออังกฤษ (คีย์นี้ถูกต้อง)
+                "name_th": subj["name_th"], # ส่งชื่อไทย (คีย์นี้ก็ถูกต้อง)
+                "time": s["time"], "room": s["room"],
+                "building": s.get("building", ""), "map_image": s.get("map_image", "")
+            })
+    for classes in by_day.values():
+        classes.sort(key=lambda x: parse_time(x['time']))
+    return by_day
+
+# ------------------- Browser ------------------- #
+MAX_CONTEXTS = int(os.getenv("MAX_CONTEXTS", "4"))
+CONTEXT_WAIT_TIMEOUT = int(os.getenv("CONTEXT_WAIT_TIMEOUT", "60"))
+BLOCKED_RESOURCES = {"image", "media", "font", "stylesheet"}
+
+async def block_resources(route):
+    # We only read DOM text, so skip everything that is just for display
+    if route.request.resource_type in BLOCKED_RESOURCES: await route.abort()
+    else: await route.continue_()
+
+async def new_scrape_context():
+    context = await app.state.browser.new_context(viewport={'width': 1280, 'height': 720})
+    await context.route("**/*", block_resources)
+    return context
+
+async def launch_browser():
+    return await app.state.playwright.chromium.launch(
+        headless=True,
+        args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-blink-features=AutomationControlled', '--disable-gpu', '--disable-dev-shm-usage'] 
+    )
+
+async def ensure_browser():
+    # Chromium can die under us (OOM, /dev/shm), so relaunch it instead of failing forever
+    async with app.state.browser_lock:
+        if app.state.browser is not None:
+            if app.state.browser.is_connected(): return
+            log("⚠️ Browser disconnected, relaunching...")
+            try: await app.state.browser.close()
+            except Exception: pass
+        if app.state.playwright is None:
+            app.state.playwright = await async_playwright().start()
+        app.state.browser = await launch_browser()
+
+async def checkout_context(context):
+    await ensure_browser()
+    if context is not None and context.browser is app.state.browser:
+        return context
+    # Empty slot, or a context left over from a browser that has since been relaunched
+    return await new_scrape_context()
+
+async def reset_context(context):
+    # Pages are closed by now, taking sessionStorage with them, and context.route() already disables
+    # the HTTP cache. reg.buu.ac.th keeps its login in cookies only; if any origin ever left
+    # localStorage behind, drop the context rather than hand that state to the next student
+    if (await context.storage_state())["origins"]:
+        await context.close()
+        return None
+    await context.clear_cookies()
+    await context.clear_permissions()
+    return context
+
+@asynccontextmanager
+async def scrape_context():
+    # Contexts are reused, but each holds one login at a time and is reset before the next
+    try:
+        slot = await asyncio.wait_for(app.state.contexts.get(), CONTEXT_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise Exception("BROWSER_BUSY")
+    context = None
+    try:
+        context = await checkout_context(slot)
+        yield context
+    finally:
+        # Always give the slot back; a broken context goes back as None and is rebuilt on the next get()
+        if context is not None:
+            try:
+                context = await reset_context(context)
+            except Exception as e:
+                log(f"⚠️ Dropping broken context: {e}")
+                context = None
+        app.state.contexts.put_nowait(context)
+
+@app.on_event("startup")
+async def start_browser():
+    log("🌐 Launching browser...")
+    app.state.playwright = app.state.browser = None
+    app.state.browser_lock = asyncio.Lock()
+    app.state.contexts = asyncio.Queue()
+    try:
+        app.state.playwright = await async_playwright().start()
+        app.state.browser = await launch_browser()
+        for _ in range(MAX_CONTEXTS):
+            app.state.contexts.put_nowait(await new_scrape_context())
+        log(f"✅ Browser ready ({MAX_CONTEXTS} contexts)")
+    except Exception as e:
+        # Only /timetable needs Chromium; keep the rest of the API up and retry lazily per scrape
+        log(f"❌ Browser Error: {e}")
+    # Top up with empty slots that checkout_context fills in on first use
+    while app.state.contexts.qsize() < MAX_CONTEXTS:
+        app.state.contexts.put_nowait(None)
+
+@app.on_event("shutdown")
+async def stop_browser():
+    if app.state.browser is not None: await app.state.browser.close()
+    if app.state.playwright is not None: await app.state.playwright.stop()
 
 # ------------------- Scraping ------------------- #
-def extract_student_info(username, password):
+MAIN_TABLE_XPATH = "//*[@id='page']/table[3]/tbody/tr/td[2]/table[3]/tbody/tr/td/table/tbody"
+
+# Course list (#myTable) + weekly grid rows 3-11, as cell texts, in one round-trip
+EXTRACT_TABLES_JS = """() => {
+    const cellTexts = tr => Array.from(tr.querySelectorAll('td'), td => td.innerText.trim());
+    const myTable = Array.from(document.querySelectorAll('#myTable > tbody > tr'), cellTexts);
+    const grid = document.evaluate(
+        "%s", document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+    ).singleNodeValue;
+    const main = grid ? Array.from(grid.querySelectorAll(':scope > tr')).slice(2, 11).map(cellTexts) : [];
+    return { myTable, main };
+}""" % MAIN_TABLE_XPATH
+
+async def wait_for_first(page, *selectors, timeout):
+    tasks = [asyncio.create_task(page.wait_for_selector(sel, timeout=timeout)) for sel in selectors]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending: task.cancel()
+    # Collect results so timeouts/cancellations don't surface as unretrieved task errors
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ------------------- Login Sessions ------------------- #
+SESSION_TTL = int(os.getenv("SESSION_TTL", "900"))
+login_sessions = {}
+
+def remember_session(key, cookies, timetable_url):
+    now = time.monotonic()
+    for k in [k for k, (ts, _, _) in login_sessions.items() if now - ts >= SESSION_TTL]:
+        del login_sessions[k]
+    login_sessions[key] = (now, cookies, timetable_url)
+
+async def resume_session(context, page, key):
+    hit = login_sessions.get(key)
+    if not hit or time.monotonic() - hit[0] >= SESSION_TTL:
+        return False
+    _, cookies, timetable_url = hit
+    await context.add_cookies(cookies)
+    try:
+        await page.goto(timetable_url, timeout=30000, wait_until="domcontentloaded")
+        await page.wait_for_selector("#myTable tbody tr", timeout=5000)
+        return True
+    except Exception:
+        # reg.buu.ac.th dropped the session and bounced us to login
+        login_sessions.pop(key, None)
+        return False
+
+async def extract_student_info(username, password):
     log(f"🚀 Scraping: {username}")
-    with sync_playwright() as p:
-        browser = p.chromium.launch(
-            headless=True,
-            args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-blink-features=AutomationControlled'] 
-        )
-        context = browser.new_context(viewport={'width': 1280, 'height': 720})
-        page = context.new_page()
+    async with scrape_context() as context:
+        page = await context.new_page()
         
         try:
-            page.goto("https://reg.buu.ac.th/", timeout=60000)
-            try: page.wait_for_load_state("domcontentloaded", timeout=10000)
-            except: pass
-
-            if page.locator("input[name='f_uid']").count() > 0:
-                pass
-            elif page.locator("text=เข้าสู่ระบบ").count() > 0:
-                page.click("text=เข้าสู่ระบบ")
+            session_key = scrape_cache_key(username, password)
+            if await resume_session(context, page, session_key):
+                log("♻️ Reusing login session")
             else:
-                page.reload()
-                if page.locator("text=เข้าสู่ระบบ").count() > 0:
-                    page.click("text=เข้าสู่ระบบ")
-
-            log("🔑 Logging in...")
-            page.wait_for_selector("input[name='f_uid']", timeout=60000)
-            page.fill("input[name='f_uid']", username)
-            page.fill("input[name='f_pwd']", password)
-            page.click("input[type='submit']", force=True)
-            time.sleep(3)
+                await context.clear_cookies()
+                await page.goto("https://reg.buu.ac.th/", timeout=60000, wait_until="domcontentloaded")
+
+                if await page.locator("input[name='f_uid']").count() > 0:
+                    pass
+                elif await page.locator("text=เข้าสู่ระบบ").count() > 0:
+                    await page.click("text=เข้าสู่ระบบ")
+                else:
+                    await page.reload()
+                    if await page.locator("text=เข้าสู่ระบบ").count() > 0:
+                        await page.click("text=เข้าสู่ระบบ")
+
+                log("🔑 Logging in...")
+                await page.wait_for_selector("input[name='f_uid']", timeout=60000)
+                await page.fill("input[name='f_uid']", username)
+                await page.fill("input[name='f_pwd']", password)
+                await page.click("input[type='submit']", force=True)
+                # Stop waiting as soon as either the menu or the wrong-password message shows up
+                await wait_for_first(page, "text=ตารางเรียน/สอบ", "text=รหัสผ่านไม่ถูกต้อง", timeout=10000)
             
-            if page.locator("text=ตารางเรียน/สอบ").count() == 0:
-                if page.locator("text=รหัสผ่านไม่ถูกต้อง").count() > 0:
-                    raise Exception("WRONG_PASSWORD")
-                log("❌ Login failed")
-                return [] 
+                if await page.locator("text=ตารางเรียน/สอบ").count() == 0:
+                    if await page.locator("text=รหัสผ่านไม่ถูกต้อง").count() > 0:
+                        raise Exception("WRONG_PASSWORD")
+                    # Neither page showed up in time; fail so nothing gets cached or overwritten with []
+                    raise Exception("LOGIN_FAILED")
             
-            log("✅ Login success")
-            page.click("text=ตารางเรียน/สอบ")
+                log("✅ Login success")
+                await page.click("text=ตารางเรียน/สอบ")
             
-            try: page.wait_for_selector("#myTable", timeout=15000)
-            except: pass
+                try: await page.wait_for_selector("#myTable tbody tr", timeout=15000)
+                except Exception: pass
+                else: remember_session(session_key, await context.cookies(), page.url)
             
             log("📚 Reading data...")
+            tables = await page.evaluate(EXTRACT_TABLES_JS)
+
             myTable_raw = {}
-            rows = page.locator("//*[@id='myTable']/tbody/tr")
-            for i in range(rows.count()):
-                cols = rows.nth(i).locator("td")
-                if cols.count() >= 2:
-                    code = safe_text(cols.nth(0))
-                    if code:
-                        name_html = cols.nth(1).inner_html().replace("<br>", "\n").replace("<br/>", "\n")
-                        name_text = page.evaluate("html => { let div = document.createElement('div'); div.innerHTML = html; return div.innerText; }", name_html)
-                        lines = [x.strip() for x in name_text.split('\n') if x.strip()]
-                        myTable_raw[code] = {
-                            "code": code, 
-                            "name_en": lines[0] if len(lines)>0 else "", 
-                            "name_th": lines[1] if len(lines)>1 else ""
-                        }
+            for cells in tables["myTable"]:
+                if len(cells) >= 2 and cells[0]:
+                    code = cells[0]
+                    lines = [x.strip() for x in cells[1].split('\n') if x.strip()]
+                    myTable_raw[code] = {
+                        "code": code, 
+                        "name_en": lines[0] if len(lines)>0 else "", 
+                        "name_th": lines[1] if len(lines)>1 else ""
+                    }
 
             mainTable_raw = []
-            for i in range(3, 12):
-                row = page.locator(f"//*[@id='page']/table[3]/tbody/tr/td[2]/table[3]/tbody/tr/td/table/tbody/tr[{i}]")
-                if row.count() > 0:
-                    cols = row.locator("td")
-                    day = safe_text(cols.nth(0)) if cols.count() > 0 else ""
-                    if day:
-                        col_data = []
-                        for j in range(1, cols.count()):
-                            txt = safe_text(cols.nth(j))
-                            if txt: col_data.append(txt.split())
-                        mainTable_raw.append({"day": day, "columns": col_data})
+            for cells in tables["main"]:
+                day = cells[0] if cells else ""
+                if day:
+                    col_data = [txt.split() for txt in cells[1:] if txt]
+                    mainTable_raw.append({"day": day, "columns": col_data})
 
             finalTable = []
             seen = set()
@@ -198,7 +499,7 @@ def extract_student_info(username, password):
                     code = col[0]
                     room = col[2] if len(col) > 2 else "-"
                     time_val = col[3].replace("(", "").replace(")", "") if len(col) > 3 else "-"
-                    key = f"{code}|{day}|{time_val}"
+                    key = (code, day, time_val)
                     if key in seen: continue
                     seen.add(key)
                     if code in myTable_raw:
@@ -230,9 +531,80 @@ def extract_student_info(username, password):
             log(f"❌ Scraping Error: {e}")
             raise e
         finally:
-            browser.close()
+            await page.close()
+
+# ------------------- Scrape Cache ------------------- #
+SCRAPE_CACHE_TTL = int(os.getenv("SCRAPE_CACHE_TTL", "120"))
+scrape_cache = {}
+
+def scrape_cache_key(username, password):
+    # Never keep the plaintext password around, only its digest
+    return (username, hashlib.sha256(password.encode()).hexdigest())
+
+def get_cached_schedule(key):
+    hit = scrape_cache.get(key)
+    if hit and time.monotonic() - hit[0] < SCRAPE_CACHE_TTL:
+        return hit[1]
+    return None
+
+def cache_schedule(key, schedule):
+    now = time.monotonic()
+    for k in [k for k, (ts, _) in scrape_cache.items() if now - ts >= SCRAPE_CACHE_TTL]:
+        del scrape_cache[k]
+    scrape_cache[key] = (now, schedule)
+
+async def fetch_timetable(username, password):
+    cache_key = scrape_cache_key(username, password)
+    schedule = get_cached_schedule(cache_key)
+    if schedule is not None:
+        log(f"⚡ Cache hit: {username}")
+        return schedule
+
+    data = await extract_student_info(username, password)
+    schedule = enrich_schedule(data)
+    await run_in_threadpool(store_schedule, username, schedule)
+    cache_schedule(cache_key, schedule)
+    return schedule
+
+SCRAPE_ERRORS = {
+    "WRONG_PASSWORD": (401, "รหัสผ่านไม่ถูกต้อง"),
+    "LOGIN_FAILED": (502, "reg.buu.ac.th ไม่ตอบสนอง กรุณาลองใหม่อีกครั้ง"),
+    "BROWSER_BUSY": (503, "ระบบกำลังยุ่ง กรุณาลองใหม่อีกครั้ง"),
+}
+
+def scrape_error(e):
+    # Shared by /timetable and the job runner so both report the same (status_code, detail)
+    for token, error in SCRAPE_ERRORS.items():
+        if token in str(e): return error
+    return 500, str(e)
+
+# ------------------- Timetable Jobs ------------------- #
+JOB_TTL = int(os.getenv("JOB_TTL", "600"))
+timetable_jobs = {}
+
+def create_timetable_job():
+    now = time.monotonic()
+    for k in [k for k, job in timetable_jobs.items() if now - job["created"] >= JOB_TTL]:
+        del timetable_jobs[k]
+    job_id = uuid.uuid4().hex
+    timetable_jobs[job_id] = {"created": now, "status": "pending"}
+    return job_id
+
+async def run_timetable_job(job_id, username, password):
+    job = timetable_jobs[job_id]
+    try:
+        job["data"] = await fetch_timetable(username, password)
+        job["status"] = "success"
+    except Exception as e:
+        log(f"❌ Job Error: {e}")
+        job["status"] = "error"
+        job["status_code"], job["detail"] = scrape_error(e)
 
 # --- API ---
+def orjson_response(content):
+    # Returning a Response skips FastAPI's jsonable_encoder walk over the payload
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -242,60 +614,89 @@ class TokenRequest(BaseModel):
     line_token: str
 
 @app.post("/timetable")
-def api_login(req: LoginRequest, db: Session = Depends(get_db)):
+async def api_login(req: LoginRequest):
     log(f"📩 Login: {req.username}")
     try:
-        data = extract_student_info(req.username, req.password)
-        
-        enriched_schedule = []
-        for subject in data:
-            enriched_sessions = []
-            for session in subject.get("schedules", []):
-                b_name, img_url = get_room_details(session["room"])
-                new_session = {
-                    "day": session["day"], "time": session["time"], "room": session["room"],
-                    "building": b_name, "map_image": img_url
-                }
-                enriched_sessions.append(new_session)
-            
-            new_subject = subject.copy()
-            new_subject["schedules"] = enriched_sessions
-            enriched_schedule.append(new_subject)
-
-        user = db.query(UserDB).filter(UserDB.username == req.username).first()
-        if not user:
-            user = UserDB(username=req.username)
-            db.add(user)
-        
-        user.schedule_json = json.dumps(enriched_schedule, ensure_ascii=False)
-        user.last_updated = datetime.now()
-        db.commit()
-        
-        return {"status": "success", "data": enriched_schedule}
+        enriched_schedule = await fetch_timetable(req.username, req.password)
+        return orjson_response({"status": "success", "data": enriched_schedule})
     except Exception as e:
         log(f"❌ API Error: {e}")
-        if "WRONG_PASSWORD" in str(e):
-            raise HTTPException(status_code=401, detail="รหัสผ่านไม่ถูกต้อง")
-        raise HTTPException(status_code=500, detail=str(e))
+        status_code, detail = scrape_error(e)
+        raise HTTPException(status_code=status_code, detail=detail)
+
+@app.post("/timetable/jobs", status_code=202)
+async def api_login_job(req: LoginRequest, background_tasks: BackgroundTasks):
+    log(f"📩 Login job: {req.username}")
+    job_id = create_timetable_job()
+    background_tasks.add_task(run_timetable_job, job_id, req.username, req.password)
+    return {"status": "pending", "job_id": job_id}
+
+@app.get("/timetable/jobs/{job_id}")
+def api_login_job_status(job_id: str):
+    # Only the worker that ran POST /timetable/jobs knows the id; run a single worker to poll reliably
+    job = timetable_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return orjson_response({k: v for k, v in job.items() if k != "created"})
 
 @app.post("/save-line-token")
 def api_save_token(req: TokenRequest, db: Session = Depends(get_db)):
     log(f"📩 Save Telegram ID: {req.username}")
     try:
-        user = db.query(UserDB).filter(UserDB.username == req.username).first()
-        if not user:
-            user = UserDB(username=req.username)
-            db.add(user)
-        user.line_token = req.line_token
+        # last_updated also versions the n8n export's ETag
+        upsert_user(db, req.username, line_token=req.line_token, last_updated=datetime.now())
         db.commit()
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/admin/refresh-maps")
+def api_refresh_maps():
+    log("📩 Refresh maps")
+    count = refresh_map_index()
+    return {"status": "success", "count": count}
+
+def stream_daily_schedules(target_day):
+    # Owns its session: dependency sessions are closed before a streamed body is sent
+    with SessionLocal() as db:
+        rows = db.query(UserDB.username, UserDB.line_token, DailyScheduleDB.classes_json).join(
+            DailyScheduleDB, DailyScheduleDB.username == UserDB.username
+        ).filter(UserDB.line_token.isnot(None), DailyScheduleDB.day == target_day).yield_per(200)
+
+        count = 0
+        yield b'{"data":['
+        for row in rows:
+            if not row.classes_json: continue
+            item = {"username": row.username, "line_user_id": row.line_token, "day": target_day, "classes": row.classes_json}
+            yield (b"," if count else b"") + orjson.dumps(item)
+            count += 1
+        yield b'],"count":%d}' % count
+
+DAILY_CACHE_TTL = int(os.getenv("DAILY_CACHE_TTL", "60"))
+daily_cache = {}
+# Memo writers run in Starlette's threadpool (sync generator), so guard every access
+daily_cache_lock = threading.Lock()
+
+def daily_etag(db, target_day):
+    # Every write to a user's schedule or token bumps last_updated
+    latest, users = db.query(func.max(UserDB.last_updated), func.count(UserDB.username)).one()
+    return '"%s"' % hashlib.md5(f"{target_day}|{latest}|{users}".encode()).hexdigest()
+
+def memo_daily_schedules(etag, target_day):
+    chunks = []
+    for chunk in stream_daily_schedules(target_day):
+        chunks.append(chunk)
+        yield chunk
+    body = b"".join(chunks)
+    now = time.monotonic()
+    with daily_cache_lock:
+        for k in [k for k, (at, _) in daily_cache.items() if now - at >= DAILY_CACHE_TTL]:
+            del daily_cache[k]
+        daily_cache[etag] = (now, body)
+
 @app.get("/daily-schedule-all")
-def api_n8n(db: Session = Depends(get_db)):
+def api_n8n(request: Request, db: Session = Depends(get_db)):
     log("📩 n8n triggered")
-    users = db.query(UserDB).filter(UserDB.line_token != None).all()
     
     thai_days = {"Monday": "จันทร์", "Tuesday": "อังคาร", "Wednesday": "พุธ", "Thursday": "พฤหัสบดี", "Friday": "ศุกร์", "Saturday": "เสาร์", "Sunday": "อาทิตย์"}
     target_day = thai_days.get(datetime.now().strftime("%A"), "จันทร์")
@@ -303,28 +704,14 @@ def api_n8n(db: Session = Depends(get_db)):
     # Mock วันจันทร์ (เอาออกเมื่อใช้จริง)
     # target_day = "จันทร์"
 
-    output = []
-    for user in users:
-        if not user.schedule_json: continue
-        try: full_schedule = json.loads(user.schedule_json)
-        except: continue
-
-        classes = []
-        for subj in full_schedule:
-            for s in subj.get("schedules", []):
-                if s.get("day") == target_day:
-                    classes.append({
-                        "code": subj["code"], 
-                        "name_en": subj["name_en"], # ส่งชื่ออังกฤษ (คีย์นี้ถูกต้อง)
-                        "name_th": subj["name_th"], # ส่งชื่อไทย (คีย์นี้ก็ถูกต้อง)
-                        "time": s["time"], "room": s["room"],
-                        "building": s.get("building", ""), "map_image": s.get("map_image", "")
-                    })
-        if classes:
-            classes.sort(key=lambda x: parse_time(x['time']))
-            output.append({"username": user.username, "line_user_id": user.line_token, "day": target_day, "classes": classes})
-    
-    return {"count": len(output), "data": output}
+    etag = daily_etag(db, target_day)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    with daily_cache_lock: cached = daily_cache.get(etag)
+    if cached and time.monotonic() - cached[0] < DAILY_CACHE_TTL:
+        return Response(cached[1], media_type="application/json", headers={"ETag": etag})
+    return StreamingResponse(memo_daily_schedules(etag, target_day), media_type="application/json", headers={"ETag": etag})
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8080)